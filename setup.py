@@ -25,6 +25,12 @@ setup(
     ],
     url='https://github.com/transifex/transifex-python',
     install_requires=[
-        'pyseeyou', 'pytz', 'requests', 'click', 'asttokens'
+        'pyseeyou', 'pytz', 'requests', 'click', 'asttokens',
+        'futures; python_version < "3.2"',
     ],
+    extras_require={
+        'streaming': ['ijson>=3.1'],
+        'orjson': ['orjson; python_version >= "3.6"'],
+        'brotli': ['urllib3[brotli]'],
+    },
 )
@@ -1,11 +1,89 @@
+import binascii
+import gzip
+import json
+import os
+import threading
+from io import BytesIO
 from operator import itemgetter
 
 import pytest
 import responses
 from mock import patch
+from requests.packages.urllib3.util.request import ACCEPT_ENCODING
 from transifex.native.cds import CDSHandler
 from transifex.native.parsing import SourceString
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+def _logged_message(patched_method):
+    """Return the message of the last call to the given patched logger
+    method, formatted the way `logging` would."""
+    args = patched_method.call_args[0]
+    return args[0] % args[1:]
+
+
+_LOCAL_TRANSLATIONS = {
+    'key{}'.format(i): {'string': 'translation {}'.format(i)}
+    for i in range(5000)
+}
+
+
+def _gzip(body):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+class _TranslationsHandler(BaseHTTPRequestHandler):
+    """Serves translations over keep-alive connections, and records each
+    connection it accepts.
+
+    Conditional requests get an empty 304. Other requests get a 200 whose
+    `data` is followed by a `meta` object too large to be read along with it.
+    The body is gzip-encoded for `el` and left uncompressed for other
+    languages.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.server.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match'):
+            self.send_response(304)
+            body = b''
+        else:
+            self.send_response(200)
+            body = json.dumps({
+                'data': _LOCAL_TRANSLATIONS,
+                # Random, so that it stays large after compression
+                'meta': {'some_key': binascii.hexlify(
+                    os.urandom(256 * 1024)).decode('ascii')},
+            }).encode('utf-8')
+            if self.path.endswith('/el'):
+                body = _gzip(body)
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', 'some_unique_tag_is_here')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+
 
 class TestCDSHandler(object):
 
@@ -54,6 +132,7 @@ class TestCDSHandler(object):
         )
         assert patched_logger.error.call_count == 0
         responses.reset()
+        cds_handler.invalidate_languages_cache()
 
         # wrong payload structure
         responses.add(
@@ -98,7 +177,7 @@ class TestCDSHandler(object):
         )
 
         assert cds_handler.fetch_languages() == []
-        patched_logger.error.assert_called_with(
+        assert _logged_message(patched_logger.error) == (
             'Error retrieving languages from CDS: UnknownError (`400 Client '
             'Error: Bad Request for url: https://some.host/languages`)'
         )
@@ -123,7 +202,7 @@ class TestCDSHandler(object):
         )
 
         assert cds_handler.fetch_languages() == []
-        patched_logger.error.assert_called_with(
+        assert _logged_message(patched_logger.error) == (
             'Error retrieving languages from CDS: UnknownError (`403 Client '
             'Error: Forbidden for url: https://some.host/languages`)'
         )
@@ -136,6 +215,35 @@ class TestCDSHandler(object):
         )
         responses.reset()
 
+    @responses.activate
+    def test_fetch_languages_cache(self):
+        cds_host = 'https://some.host'
+        cds_handler = CDSHandler(
+            ['el', 'en'],
+            'some_token',
+            host=cds_host
+        )
+        responses.add(responses.GET, cds_host + '/languages',
+                      json={'data': [{'code': "el"}, {'code': "en"}]},
+                      status=200)
+
+        languages = cds_handler.fetch_languages()
+        assert languages == [{'code': 'el'}, {'code': 'en'}]
+        # mutating the returned list does not affect the cache
+        languages.pop()
+        assert cds_handler.fetch_languages() == [{'code': 'el'},
+                                                 {'code': 'en'}]
+        assert len(responses.calls) == 1
+
+        cds_handler.invalidate_languages_cache()
+        cds_handler.fetch_languages()
+        assert len(responses.calls) == 2
+
+        # expired cache
+        cds_handler._languages_ttl = 0
+        cds_handler.fetch_languages()
+        assert len(responses.calls) == 3
+
     @responses.activate
     @patch('transifex.native.cds.logger')
     def test_fetch_translations(self, patched_logger):
@@ -173,7 +281,8 @@ class TestCDSHandler(object):
             json={
                 'data': {
                     'key1': {
-                        'string': 'key1_el'
+                        'string': 'key1_el',
+                        'rank': 1.5,
                     },
                     'key2': {
                         'string': 'key2_el'
@@ -210,7 +319,8 @@ class TestCDSHandler(object):
         assert resp == {
             'el': (True, {
                 'key1': {
-                    'string': 'key1_el'
+                    'string': 'key1_el',
+                    'rank': 1.5,
                 },
                 'key2': {
                     'string': 'key2_el'
@@ -226,15 +336,18 @@ class TestCDSHandler(object):
             }),
             'fr': (False, {})  # that is due to the error status in response
         }
+        # numbers are parsed the same way as with `response.json()`
+        assert isinstance(resp['el'][1]['key1']['rank'], float)
 
         responses.reset()
+        cds_handler.invalidate_languages_cache()
 
         # test fetch_languages fails with connection error
         responses.add(responses.GET, cds_host + '/languages', status=500)
         resp = cds_handler.fetch_translations()
         assert resp == {}
 
-        patched_logger.error.assert_called_with(
+        assert _logged_message(patched_logger.error) == (
             'Error retrieving languages from CDS: UnknownError '
             '(`500 Server Error: Internal Server Error for url: '
             'https://some.host/languages`)'
@@ -281,6 +394,36 @@ class TestCDSHandler(object):
         )
         assert resp == {'el': (False, {})}
 
+        # languages that are not configured are not fetched at all
+        patched_logger.reset_mock()
+        assert cds_handler.fetch_translations(language_code='de') == {}
+        assert patched_logger.error.call_count == 0
+
+    @responses.activate
+    @patch('transifex.native.cds._release_connection')
+    @patch('transifex.native.cds.logger')
+    def test_fetch_translations_malformed_response(self, patched_logger,
+                                                   patched_release):
+        cds_host = 'https://some.host'
+        cds_handler = CDSHandler(
+            ['el', 'en'],
+            'some_token',
+            host=cds_host
+        )
+        responses.add(responses.GET, cds_host + '/content/el',
+                      json={'wrong_key': {}}, status=200)
+        responses.add(responses.GET, cds_host + '/content/en',
+                      body='{"data": {', status=200)
+
+        for language_code in ('el', 'en'):
+            resp = cds_handler.fetch_translations(language_code)
+            assert resp == {language_code: (False, {})}
+            patched_logger.error.assert_called_with(
+                'Error retrieving translations from CDS: Malformed response'
+            )
+            # a broken body is not drained, so its error is the one reported
+            assert patched_release.call_count == 0
+
     @responses.activate
     @patch('transifex.native.cds.logger')
     def test_fetch_translations_etags_management(self, patched_logger):
@@ -351,6 +494,28 @@ class TestCDSHandler(object):
         }
         assert cds_handler.etags.get('el') == 'some_unique_tag_is_here'
 
+        # subsequent fetches are conditional
+        responses.reset()
+        responses.add(responses.GET, cds_host + '/content/el', status=304)
+        resp = cds_handler.fetch_translations(language_code='el')
+        assert resp == {'el': (False, {})}
+        assert (responses.calls[0].request.headers['If-None-Match'] ==
+                'some_unique_tag_is_here')
+
+    @responses.activate
+    @patch('transifex.native.cds.logger')
+    def test_fetch_translations_etag_not_stored_on_error(self,
+                                                         patched_logger):
+        cds_host = 'https://some.host'
+        cds_handler = CDSHandler(['el'], 'some_token', host=cds_host)
+        responses.add(responses.GET, cds_host + '/content/el',
+                      json={'wrong_key': {}}, status=200,
+                      headers={'ETag': 'some_unique_tag_is_here'})
+
+        resp = cds_handler.fetch_translations(language_code='el')
+        assert resp == {'el': (False, {})}
+        assert cds_handler.etags.get('el') == ''
+
     def test_push_source_strings_no_secret(self):
         cds_handler = CDSHandler(
             ['el', 'en'],
@@ -370,14 +535,21 @@ class TestCDSHandler(object):
             host=cds_host
         )
 
-        # test push no correct
+        # test push no content
         responses.add(
             responses.POST, cds_host + '/content/',
             status=200, json={'data': []}
         )
 
-        cds_handler.push_source_strings([], False)
+        response = cds_handler.push_source_strings([], False)
         assert patched_logger.error.call_count == 0
+        assert response.status_code == 204
+        assert len(responses.calls) == 0
+
+        # purging with no content still reaches the CDS
+        cds_handler.push_source_strings([], True)
+        assert patched_logger.error.call_count == 0
+        assert len(responses.calls) == 1
 
         # test push with content
         responses.add(
@@ -385,9 +557,24 @@ class TestCDSHandler(object):
             status=200, json={'data': []}
         )
 
-        source_string = SourceString('some_string')
-        cds_handler.push_source_strings([source_string], False)
+        source_string = SourceString('some_string', _context='ctx',
+                                     _comment='a comment')
+        cds_handler.push_source_strings([source_string], True)
         assert patched_logger.error.call_count == 0
+        request = responses.calls[-1].request
+        assert request.headers['Content-Type'] == 'application/json'
+        assert json.loads(request.body.decode('utf-8')) == {
+            'data': {
+                source_string.key: {
+                    'string': 'some_string',
+                    'meta': {
+                        'context': ['ctx'],
+                        'developer_comment': 'a comment',
+                    },
+                },
+            },
+            'meta': {'purge': True},
+        }
         responses.reset()
 
         # test wrong data format
@@ -414,7 +601,7 @@ class TestCDSHandler(object):
         )
         # we don't care about the payload this time, just want to
         # see how the service handles the errors
-        cds_handler.push_source_strings([], False)
+        cds_handler.push_source_strings([source_string], False)
         # The actual error message differs between Python 2 and Python 3
         messages = [
             'Error pushing source strings to CDS: UnknownError '
@@ -422,7 +609,11 @@ class TestCDSHandler(object):
             'https://some.host/content/`)'.format(err=x)
             for x in ('Unprocessable Entity', 'None')
         ]
-        assert patched_logger.error.call_args[0][0] in messages
+        assert _logged_message(patched_logger.error) in messages
+        request = responses.calls[-1].request
+        assert json.loads(request.body.decode('utf-8'))['meta'] == {
+            'purge': False,
+        }
 
     def test_get_headers(self):
         cds_host = 'https://some.host'
@@ -434,13 +625,13 @@ class TestCDSHandler(object):
         )
         assert cds_handler._get_headers() == {
             'Authorization': 'Bearer some_token',
-            'Accept-Encoding': 'gzip',
+            'Accept-Encoding': ACCEPT_ENCODING,
             'X-NATIVE-SDK': 'python',
         }
 
         assert cds_handler._get_headers(use_secret=True) == {
             'Authorization': 'Bearer some_token:some_secret',
-            'Accept-Encoding': 'gzip',
+            'Accept-Encoding': ACCEPT_ENCODING,
             'X-NATIVE-SDK': 'python',
         }
 
@@ -448,11 +639,23 @@ class TestCDSHandler(object):
             use_secret=True, etag='something')
         assert headers == {
             'Authorization': 'Bearer some_token:some_secret',
-            'Accept-Encoding': 'gzip',
+            'Accept-Encoding': ACCEPT_ENCODING,
             'X-NATIVE-SDK': 'python',
             'If-None-Match': 'something',
         }
 
+        assert cds_handler._push_headers == {
+            'Authorization': 'Bearer some_token:some_secret',
+            'Accept-Encoding': ACCEPT_ENCODING,
+            'X-NATIVE-SDK': 'python',
+            'Content-Type': 'application/json',
+        }
+        assert cds_handler._get_etag_headers('el') is None
+        cds_handler.etags.set('el', 'something')
+        assert cds_handler._get_etag_headers('el') == {
+            'If-None-Match': 'something',
+        }
+
     @responses.activate
     def test_retry_fetch_languages(self):
         cds_host = 'https://some.host'
@@ -491,3 +694,100 @@ class TestCDSHandler(object):
         translations = cds_handler.fetch_translations('el')
         assert (translations ==
                 {'el': (True, {'source': {'string': "translation"}})})
+
+    @patch('transifex.native.cds.requests.Session.close')
+    def test_close(self, patched_close):
+        cds_handler = CDSHandler(['el', 'en'], 'some_token')
+        assert (cds_handler._session.headers['Authorization'] ==
+                'Bearer some_token')
+        cds_handler.close()
+        assert patched_close.call_count == 1
+
+    @responses.activate
+    @patch('time.sleep')
+    @patch('transifex.native.cds.logger')
+    def test_retry_transient_errors(self, patched_logger, patched_sleep):
+        cds_host = 'https://some.host'
+        cds_handler = CDSHandler(
+            ['el', 'en'],
+            'some_token',
+            secret='some_secret',
+            host=cds_host,
+        )
+        responses.add(responses.GET, cds_host + '/languages', status=503)
+        responses.add(responses.GET, cds_host + '/languages',
+                      json={'data': [{'code': "el"}]}, status=200)
+        assert cds_handler.fetch_languages() == [{'code': 'el'}]
+        assert len(responses.calls) == 2
+        assert patched_logger.warning.call_count == 1
+        assert patched_logger.error.call_count == 0
+
+        # pushing source strings is not retried
+        responses.reset()
+        patched_logger.reset_mock()
+        responses.add(responses.POST, cds_host + '/content/', status=503)
+        cds_handler.push_source_strings([SourceString('some_string')])
+        assert len(responses.calls) == 1
+        assert patched_logger.warning.call_count == 0
+        assert patched_logger.error.call_count == 1
+
+    @responses.activate
+    def test_host_normalization(self):
+        cds_handler = CDSHandler(['el'], 'some_token',
+                                 host='https://some.host/')
+        assert cds_handler.host == 'https://some.host'
+        responses.add(responses.GET, 'https://some.host/content/el',
+                      json={'data': {}}, status=200)
+        assert cds_handler.fetch_translations('el') == {'el': (True, {})}
+
+    def _start_local_server(self):
+        server = _LocalServer(('127.0.0.1', 0), _TranslationsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cds_handler = CDSHandler(
+            ['el', 'en'], 'some_token',
+            host='http://127.0.0.1:{}'.format(server.server_address[1]),
+        )
+        return server, cds_handler
+
+    def _stop_local_server(self, server, cds_handler):
+        cds_handler.close()
+        server.shutdown()
+        server.server_close()
+
+    def test_not_modified_responses_reuse_connection(self):
+        server, cds_handler = self._start_local_server()
+        try:
+            cds_handler.etags.set('el', 'some_unique_tag_is_here')
+            for _ in range(2):
+                resp = cds_handler.fetch_translations(language_code='el')
+                assert resp == {'el': (False, {})}
+        finally:
+            self._stop_local_server(server, cds_handler)
+        assert server.connections == 1
+
+    def test_partially_parsed_responses_reuse_connection(self):
+        server, cds_handler = self._start_local_server()
+        try:
+            # `el` is compressed, `en` is not
+            for language_code in ('el', 'en'):
+                resp = cds_handler.fetch_translations(language_code)
+                assert resp == {language_code: (True, _LOCAL_TRANSLATIONS)}
+                resp = cds_handler.fetch_translations(language_code)
+                assert resp == {language_code: (False, {})}
+        finally:
+            self._stop_local_server(server, cds_handler)
+        assert server.connections == 1
+
+    @responses.activate
+    @patch('transifex.native.cds.ThreadPoolExecutor')
+    def test_fetch_single_language_inline(self, patched_executor):
+        cds_host = 'https://some.host'
+        cds_handler = CDSHandler(['el', 'en'], 'some_token', host=cds_host)
+        responses.add(responses.GET, cds_host + '/content/el',
+                      json={'data': {}}, status=200)
+
+        assert cds_handler.fetch_translations('el') == {'el': (True, {})}
+        assert cds_handler.fetch_translations('de') == {}
+        assert patched_executor.call_count == 0
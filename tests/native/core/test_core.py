@@ -218,6 +218,10 @@ class TestNative(object):
         mytx.push_source_strings(strings, False)
         mock_push_strings.assert_called_once_with(strings, False)
 
+    def test_push_no_strings(self):
+        mytx = self._get_tx(secret='some_secret')
+        assert mytx.push_source_strings([], False) == (204, {})
+
     @patch('transifex.native.core.MemoryCache.update')
     @patch('transifex.native.core.CDSHandler.fetch_translations')
     def test_fetch_translations_reaches_cds_handler_and_cache(self, mock_cds,
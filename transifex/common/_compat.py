@@ -1,4 +1,5 @@
 import sys
+import time
 
 PYVER = sys.version_info[0]
 PY3 = PYVER == 3
@@ -8,7 +9,9 @@ if PY3:
     string_types = (str,)
     text_type = str
     binary_type = bytes
+    monotonic = time.monotonic
 else:
     string_types = basestring,
     text_type = unicode
     binary_type = str
+    monotonic = time.time
@@ -1,11 +1,28 @@
+import json
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.request import ACCEPT_ENCODING
+from requests.packages.urllib3.util.retry import Retry
+from transifex.common._compat import monotonic
 from transifex.native.consts import (KEY_CHARACTER_LIMIT,
                                      KEY_DEVELOPER_COMMENT, KEY_OCCURRENCES,
                                      KEY_TAGS)
 
+try:
+    import ijson
+except ImportError:  # pragma no cover
+    ijson = None
+
+try:
+    import orjson
+except ImportError:  # pragma no cover
+    orjson = None
+
 TRANSIFEX_CDS_HOST = 'https://cds.svc.transifex.net'
 
 TRANSIFEX_CDS_URLS = {
@@ -14,8 +31,12 @@ TRANSIFEX_CDS_URLS = {
     'PUSH_SOURCE_STRINGS': '/content/'
 }
 
+_get_code = itemgetter('code')
+
 logger = logging.getLogger('transifex.native.cds')
-logger.addHandler(logging.StreamHandler(sys.stderr))
+# Guard against adding another handler each time the module is reloaded
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler(sys.stderr))
 
 
 # A mapping of meta keys
@@ -29,6 +50,63 @@ MAPPING = {
 }
 
 
+def _dumps(obj):
+    """Serialize the given object to a JSON-encoded bytestring.
+
+    Uses `orjson` if available, which is considerably faster than the
+    standard library for large payloads.
+
+    :param obj: the object to serialize
+    :return: the UTF-8 encoded JSON document
+    :rtype: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')  # pragma no cover
+
+
+# `method_whitelist` was renamed to `allowed_methods` in urllib3 1.26
+if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS'):
+    _RETRY_METHODS_KWARG = 'allowed_methods'
+else:  # pragma no cover
+    _RETRY_METHODS_KWARG = 'method_whitelist'
+
+
+class CDSRetry(Retry):
+    """A retry policy that logs a warning every time a request to the CDS
+    is retried."""
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        # Raises `MaxRetryError` once the retry budget is exhausted, which
+        # surfaces to the callers and is logged as an error there
+        new_retry = super(CDSRetry, self).increment(
+            method, url, *args, **kwargs)
+        logger.warning('Retrying request to CDS: %s %s', method, url)
+        return new_retry
+
+
+# Pre-serialized tails of the push payload, which only depend on `purge`
+_PURGE_META = b',"meta":{"purge":true}}'
+_NO_PURGE_META = b',"meta":{"purge":false}}'
+
+
+def _release_connection(response):
+    """Consume the unread body of a streamed response, so that its
+    connection is returned to the pool.
+
+    Closing a response with unread data drops the underlying socket, which
+    defeats keep-alive.
+
+    :param requests.Response response: a response fetched with `stream=True`
+    """
+    # Read in chunks, so that only a single chunk is held in memory, and
+    # with the decode mode the body has been read with so far: urllib3 does
+    # not allow switching it halfway through a body
+    for _ in response.raw.stream(64 * 1024):
+        pass
+    response.close()
+
+
 class EtagStore(object):
     """ Manges etags """
 
@@ -48,49 +126,74 @@ class CDSHandler(object):
     """Handles communication with the Content Delivery Service."""
 
     def __init__(self, configured_languages, token, secret=None,
-                 host=TRANSIFEX_CDS_HOST):
+                 host=TRANSIFEX_CDS_HOST, languages_ttl=300, max_workers=16):
         """Constructor.
 
         :param list configured_languages: a list of language codes for the
             configured languages in the application
         :param str token: the API token to use for connecting to the CDS
         :param str host: the host of the Content Delivery Service
+        :param int languages_ttl: the number of seconds for which the
+            languages fetched from the CDS are cached
+        :param int max_workers: the maximum number of languages whose
+            translations are fetched concurrently
         """
         self.configured_language_codes = configured_languages
+        self._configured_languages = frozenset(configured_languages)
         self.token = token
         self.secret = secret
-        self.host = host or TRANSIFEX_CDS_HOST
+        # Normalize once, so that e.g. `https://some.host/` does not produce
+        # URLs with a double slash
+        self.host = (host or TRANSIFEX_CDS_HOST).rstrip('/')
+        self._languages_url = (
+            self.host + TRANSIFEX_CDS_URLS['FETCH_AVAILABLE_LANGUAGES'])
+        # The per-language URL is the prefix followed by the language code
+        self._translations_url_prefix = (
+            self.host + TRANSIFEX_CDS_URLS['FETCH_TRANSLATIONS_FOR_LANGUAGE']
+            .format(language_code=''))
+        self._push_url = self.host + TRANSIFEX_CDS_URLS['PUSH_SOURCE_STRINGS']
         self.etags = EtagStore()
+        self._max_workers = max_workers
+        self._session = self._create_session()
+        self._push_headers = None
+        if secret:
+            self._push_headers = self._get_headers(use_secret=True)
+            self._push_headers['Content-Type'] = 'application/json'
+        self._languages_cache = None
+        self._languages_cache_timestamp = 0
+        self._languages_ttl = languages_ttl
 
     def fetch_languages(self):
         """Fetch the languages defined in the CDS for the specific project.
 
+        The result is cached for `languages_ttl` seconds, since the languages
+        of a project rarely change. Failed requests are never cached.
+
         :return: a list of language information
         :rtype: dict
         """
+        now = monotonic()
+        if (self._languages_cache is not None and
+                now - self._languages_cache_timestamp < self._languages_ttl):
+            return list(self._languages_cache)
 
-        cds_url = TRANSIFEX_CDS_URLS['FETCH_AVAILABLE_LANGUAGES']
         languages = []
 
         try:
             last_response_status = 202
             while last_response_status == 202:
-                response = requests.get(
-                    self.host + cds_url,
-                    headers=self._get_headers(),
-                )
+                response = self._session.get(self._languages_url)
                 last_response_status = response.status_code
 
             if not response.ok:
-                logger.error(
-                    'Error retrieving languages from CDS: `{}`'.format(
-                        response.reason
-                    )
-                )
+                logger.error('Error retrieving languages from CDS: `%s`',
+                             response.reason)
                 response.raise_for_status()
 
             json_content = response.json()
             languages = json_content['data']
+            self._languages_cache = list(languages)
+            self._languages_cache_timestamp = now
 
         except (KeyError, ValueError):
             # Compatibility with python2.7 where `JSONDecodeError` doesn't
@@ -102,10 +205,15 @@ class CDSHandler(object):
                 'Error retrieving languages from CDS: ConnectionError')
         except Exception as e:
             logger.error('Error retrieving languages from CDS: UnknownError '
-                         '(`{}`)'.format(str(e)))
+                         '(`%s`)', e)
 
         return languages
 
+    def invalidate_languages_cache(self):
+        """Discard the cached languages, so that the next call to
+        `fetch_languages()` hits the CDS."""
+        self._languages_cache = None
+
     def fetch_translations(self, language_code=None):
         """Fetch all translations for the given organization/project/(resource)
         associated with the current token. Returns a tuple of refresh flag and
@@ -117,66 +225,130 @@ class CDSHandler(object):
         :rtype: dict
         """
 
-        cds_url = TRANSIFEX_CDS_URLS['FETCH_TRANSLATIONS_FOR_LANGUAGE']
-
-        translations = {}
-
         if not language_code:
-            languages = [lang['code'] for lang in self.fetch_languages()]
+            languages = map(_get_code, self.fetch_languages())
         else:
-            languages = [language_code]
+            languages = (language_code,)
+        # Order does not matter, since languages are fetched concurrently
+        language_codes = self._configured_languages.intersection(languages)
+
+        if len(language_codes) <= 1:
+            return {
+                code: self._fetch_language_translations(code)
+                for code in language_codes
+            }
+
+        # Each language is fetched with a separate, independent request,
+        # so dispatch them concurrently over the pooled session
+        language_codes = list(language_codes)
+        max_workers = min(self._max_workers, len(language_codes))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            translations = dict(zip(
+                language_codes,
+                executor.map(self._fetch_language_translations,
+                             language_codes),
+            ))
 
-        for language_code in set(languages) & \
-                set(self.configured_language_codes):
+        return translations
 
-            try:
-                last_response_status = 202
-                while last_response_status == 202:
-                    response = requests.get(
-                        (self.host +
-                         cds_url.format(language_code=language_code)),
-                        headers=self._get_headers(
-                            etag=self.etags.get(language_code)
-                        )
-                    )
-                    last_response_status = response.status_code
-
-                if not response.ok:
-                    logger.error(
-                        'Error retrieving translations from CDS: `{}`'.format(
-                            response.reason
-                        )
-                    )
-                    response.raise_for_status()
-
-                # etags indicate that no translation have been updated
-                if response.status_code == 304:
-                    translations[language_code] = (False, {})
-                else:
-                    self.etags.set(
-                        language_code, response.headers.get('ETag', ''))
-                    json_content = response.json()
-                    translations[language_code] = (
-                        True, json_content['data']
-                    )
-
-            except (KeyError, ValueError):
-                # Compatibility with python2.7 where `JSONDecodeError` doesn't
-                # exist
-                logger.error('Error retrieving translations from CDS: '
-                             'Malformed response')  # pragma no cover
-                translations[language_code] = (False, {})  # pragma no cover
-            except requests.ConnectionError:
-                logger.error(
-                    'Error retrieving translations from CDS: ConnectionError')
-                translations[language_code] = (False, {})
-            except Exception as e:
-                logger.error(
-                    'Error retrieving translations from CDS: UnknownError '
-                    '(`{}`)'.format(str(e))
-                )  # pragma no cover
-                translations[language_code] = (False, {})
+    def _fetch_language_translations(self, language_code):
+        """Fetch the translations of a single language from the CDS,
+        logging any error.
+
+        :param str language_code: the language to fetch translations for
+        :return: a (refresh_flag, translations) tuple; (False, {}) if the
+            translations could not be retrieved
+        :rtype: tuple
+        """
+        try:
+            return self._request_language_translations(language_code)
+        except (KeyError, ValueError):
+            # Compatibility with python2.7 where `JSONDecodeError` doesn't
+            # exist
+            logger.error('Error retrieving translations from CDS: '
+                         'Malformed response')
+        except requests.ConnectionError:
+            logger.error(
+                'Error retrieving translations from CDS: ConnectionError')
+        except Exception as e:
+            logger.error(
+                'Error retrieving translations from CDS: UnknownError '
+                '(`%s`)', e
+            )
+        return False, {}
+
+    def _request_language_translations(self, language_code):
+        """Request the translations of a single language from the CDS.
+
+        :param str language_code: the language to fetch translations for
+        :return: a (refresh_flag, translations) tuple
+        :rtype: tuple
+        :raise requests.HTTPError: if the CDS responds with an error status
+        """
+        last_response_status = 202
+        while last_response_status == 202:
+            response = self._session.get(
+                self._translations_url_prefix + language_code,
+                headers=self._get_etag_headers(language_code),
+                stream=True,
+            )
+            last_response_status = response.status_code
+            if last_response_status != 200:
+                # Only the body of a 200 response is parsed; read the rest
+                # (empty or tiny) so that the connection is returned to the
+                # pool instead of being dropped
+                _release_connection(response)
+
+        if not response.ok:
+            logger.error('Error retrieving translations from CDS: `%s`',
+                         response.reason)
+            response.raise_for_status()
+
+        # etags indicate that no translation have been updated
+        if response.status_code == 304:
+            return False, {}
 
+        translations = self._parse_translations(response)
+        # Only remember the etag once the payload has been parsed, otherwise
+        # a malformed response would be skipped with a 304 from now on
+        self.etags.set(language_code, response.headers.get('ETag', ''))
+        return True, translations
+
+    def _parse_translations(self, response):
+        """Return the `data` object of a streamed translations response.
+
+        If `ijson` is available, the object is parsed incrementally while
+        the body is being received, without holding the whole body in memory
+        or building the rest of the document. The rest of the body is then
+        read and discarded, so that the connection can be reused.
+
+        :param requests.Response response: a response fetched with
+            `stream=True`
+        :return: the translations of the response
+        :rtype: dict
+        :raise KeyError: if the response does not contain a `data` object
+        :raise ValueError: if the response is not valid JSON
+        """
+        if ijson is None:  # pragma no cover
+            return response.json()['data']
+
+        response.raw.decode_content = True
+        try:
+            try:
+                translations = next(
+                    ijson.items(response.raw, 'data', use_float=True))
+            except StopIteration:
+                raise KeyError('data')
+            except ijson.JSONError as e:
+                raise ValueError(str(e))
+        except Exception:
+            # The stream may be broken, so do not read any further and
+            # let the original error surface
+            response.close()
+            raise
+
+        # Whatever follows `data` (e.g. `meta`) is still unread
+        _release_connection(response)
         return translations
 
     def push_source_strings(self, strings, purge=False):
@@ -187,24 +359,32 @@ class CDSHandler(object):
         :param bool purge: True deletes destination source content not included
             in pushed content. False appends the pushed content to destination
             source content.
-        :return: the HTTP response object
+        :return: the HTTP response object; an empty 204 response if there
+            was nothing to push
         :rtype: requests.Response
         """
         if not self.secret:
             raise Exception('You need to use `TRANSIFEX_SECRET` when pushing '
                             'source content')
 
-        cds_url = TRANSIFEX_CDS_URLS['PUSH_SOURCE_STRINGS']
+        # Nothing to push; a purge with no strings is still sent, since it
+        # removes all existing source content
+        if not strings and not purge:
+            logger.debug('No source strings to push to CDS, skipping')
+            response = requests.Response()
+            response.status_code = 204
+            response._content = b''
+            return response
 
-        data = {k: v for k, v in [self._serialize(item) for item in strings]}
+        data = dict(self._serialize(item) for item in strings)
         try:
-            response = requests.post(
-                self.host + cds_url,
-                headers=self._get_headers(use_secret=True),
-                json={
-                    'data': data,
-                    'meta': {'purge': purge},
-                }
+            response = self._session.post(
+                self._push_url,
+                headers=self._push_headers,
+                data=(
+                    b'{"data":' + _dumps(data) +
+                    (_PURGE_META if purge else _NO_PURGE_META)
+                ),
             )
             response.raise_for_status()
 
@@ -213,10 +393,58 @@ class CDSHandler(object):
                 'Error pushing source strings to CDS: ConnectionError')
         except Exception as e:
             logger.error('Error pushing source strings to CDS: UnknownError '
-                         '(`{}`)'.format(str(e)))
+                         '(`%s`)', e)
 
         return response
 
+    def close(self):
+        """Close the underlying HTTP session and release pooled
+        connections."""
+        self._session.close()
+
+    def _create_session(self):
+        """Create the HTTP session used for all requests to the CDS.
+
+        Connections are pooled and kept alive between requests, so that
+        consecutive calls (e.g. one per language) do not pay for a new
+        TCP/TLS handshake every time.
+
+        :return: a configured session
+        :rtype: requests.Session
+        """
+        session = requests.Session()
+        session.headers.update(self._get_headers())
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            # One pooled connection per concurrent fetch, so that none is
+            # discarded after use
+            pool_maxsize=self._max_workers,
+            max_retries=self._create_retry(),
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _create_retry(self):
+        """Create the retry policy for requests to the CDS.
+
+        Transient failures are retried with an exponential backoff. Only
+        GET requests are retried on error responses, so that pushing source
+        strings is never repeated.
+
+        :return: the retry policy
+        :rtype: CDSRetry
+        """
+        return CDSRetry(
+            total=3,
+            connect=3,
+            read=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504],
+            respect_retry_after_header=True,
+            **{_RETRY_METHODS_KWARG: frozenset(['GET'])}
+        )
+
     def _serialize(self, source_string):
         """Serialize the given source string to a format suitable for the CDS.
 
@@ -226,17 +454,22 @@ class CDSHandler(object):
             as (key, data)
         :rtype: tuple
         """
-        data = {
-            'string': source_string.string,
-            'meta': {
-                MAPPING.get(k, k): v
-                for k, v in source_string.meta.items()
-            },
-        }
+        # Called once per pushed string, so avoid the comprehension
+        # altogether for strings without meta and look up the mapping
+        # through a local name for the rest
+        meta = source_string.meta
+        if meta:
+            mapping_get = MAPPING.get
+            meta = {mapping_get(k, k): v for k, v in meta.items()}
+        else:
+            meta = {}
         if source_string.context:
-            data['meta']['context'] = source_string.context
+            meta['context'] = source_string.context
 
-        return source_string.key, data
+        return source_string.key, {
+            'string': source_string.string,
+            'meta': meta,
+        }
 
     def _get_headers(self, use_secret=False, etag=None):
         """Return the headers to use when making requests.
@@ -252,10 +485,27 @@ class CDSHandler(object):
                 token=self.token,
                 secret=(':' + self.secret if use_secret else '')
             ),
-            'Accept-Encoding': 'gzip',
+            # Advertise every encoding urllib3 can decode, e.g. `br`
+            # if `brotli` is installed
+            'Accept-Encoding': ACCEPT_ENCODING,
             'X-NATIVE-SDK': 'python',
         }
         if etag:
             headers['If-None-Match'] = etag
 
         return headers
+
+    def _get_etag_headers(self, language_code):
+        """Return the per-request headers to use when fetching translations.
+
+        Authorization and the rest of the common headers are already set on
+        the session, so only the conditional request header is added here.
+
+        :param str language_code: the language to fetch translations for
+        :return: a dictionary with the extra headers, or None
+        :rtype: dict
+        """
+        etag = self.etags.get(language_code)
+        if etag:
+            return {'If-None-Match': etag}
+        return None
@@ -165,7 +165,7 @@ class TxNative(object):
         """
         self._check_initialization()
         response = self._cds_handler.push_source_strings(strings, purge)
-        return response.status_code, json.loads(response.content)
+        return response.status_code, json.loads(response.content or '{}')
 
     def _check_initialization(self):
         """Raise an exception if the class has not been initialized.